@@ -20,6 +20,9 @@ Rev. 1 Raspberry Pis should leave bus set at 0, while rev. 2 Pis should
 set bus equal to 1. The address should be changed to match the address of
 the sensor.
 
+The gpio pin is monitored using pigpio, so the pigpiod daemon must be running
+(sudo systemctl enable --now pigpiod).  The pin is a BCM gpio number.
+
 [AS3935]
     address = 3
     bus = 1
@@ -27,6 +30,12 @@ the sensor.
     calibration = 6
     indoors = True
     pin = 17
+    max_buffer = 4096
+
+The max_buffer is the most strikes whose distance is kept between records.
+It only guards against runaway memory use; the strike count is always exact,
+but in a storm with more strikes than this the average distance is computed
+from the most recent max_buffer strikes.  Values less than 1 are treated as 1.
 
 [Engine]
     [[Services]]
@@ -71,11 +80,22 @@ Based on Phil Fenstermacher's RaspberryPi-AS3935 library and demo.py script.
 """
 
 from RPi_AS3935 import RPi_AS3935
-import RPi.GPIO as GPIO
+import pigpio
 import time
 import syslog
+import threading
+import collections
+import json
+import math
+import os
+import sqlite3
+import weedb
 import weewx
 import weewx.manager
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 from datetime import datetime
 from weewx.wxengine import StdService
 from weeutil.weeutil import to_bool
@@ -86,6 +106,38 @@ if weewx.__version__ < "3.2":
     raise weewx.UnsupportedFeature("weewx 3 is required, found %s" %
                                    weewx.__version__)
 
+# unit systems, bound once for the per-record and per-strike paths
+_US = weewx.US
+_METRIC = weewx.METRIC
+
+# integer wall-clock nanoseconds, without a float round trip where possible
+try:
+    _time_ns = time.time_ns
+except AttributeError:
+    def _time_ns():
+        return int(time.time() * 1000000000)
+
+# distances from the sensor are always in kilometers
+KM_TO_MILE = 0.621371192
+
+# the writer thread puts at most this many queued strikes in one transaction,
+# and checks for dead letters after this many idle seconds
+MAX_BATCH = 256
+FLUSH_INTERVAL = 0.5
+
+# attempts to write a batch of strikes before saving it to the dead letter
+# file, and the delay before the first retry (doubled for each retry).  only
+# operational errors, such as a locked or full database, are retried.
+WRITE_TRIES = 3
+RETRY_WAIT = 0.1
+RETRY_ERRORS = (sqlite3.OperationalError, weedb.OperationalError)
+
+# seconds to wait before dead letters are retried after a failed write.  the
+# wait doubles with each failure up to the maximum, and a successful write of
+# new strikes ends it early.
+DEADLETTER_WAIT = 60
+DEADLETTER_MAX_WAIT = 3600
+
 # uncomment this if you want to sum counts instead of getting counts per period
 #weewx.accum.extract_dict['lightning_strike_count'] = weewx.accum.Accum.sum_extract
 
@@ -99,36 +151,39 @@ def get_default_binding_dict():
             'table_name': 'archive',
             'schema': 'user.as3935.schema'}
 
+# pragmas applied to the connection that writes strikes to a sqlite lightning
+# database.  wal is persistent in the database file, the others last only for
+# the connection.
+SQLITE_PRAGMAS = ['PRAGMA journal_mode=WAL',
+                  'PRAGMA synchronous=NORMAL',
+                  'PRAGMA busy_timeout=2000',
+                  'PRAGMA temp_store=MEMORY']
+
 try:
     # Test for new-style weewx logging by trying to import weeutil.logger
     import weeutil.logger
     import logging
     log = logging.getLogger("user.as3935")
 
-    def logdbg(msg):
-        log.debug(msg)
-
-    def loginf(msg):
-        log.info(msg)
-
-    def logerr(msg):
-        log.error(msg)
+    logdbg = log.debug
+    loginf = log.info
+    logerr = log.error
 
 except ImportError:
-    # Old-style weewx logging
+    # Old-style weewx logging.  The syslog function, level and prefix are
+    # bound as defaults so each call is a single frame.
     import syslog
 
-    def logmsg(level, msg):
-        syslog.syslog(level, 'user.as3925: %s' % msg)
+    _PFX = 'user.as3935: '
 
-    def logdbg(msg):
-        logmsg(syslog.LOG_DEBUG, msg)
+    def logdbg(msg, _syslog=syslog.syslog, _level=syslog.LOG_DEBUG, _pfx=_PFX):
+        _syslog(_level, _pfx + msg)
 
-    def loginf(msg):
-        logmsg(syslog.LOG_INFO, msg)
+    def loginf(msg, _syslog=syslog.syslog, _level=syslog.LOG_INFO, _pfx=_PFX):
+        _syslog(_level, _pfx + msg)
 
-    def logerr(msg):
-        logmsg(syslog.LOG_ERR, msg)
+    def logerr(msg, _syslog=syslog.syslog, _level=syslog.LOG_ERR, _pfx=_PFX):
+        _syslog(_level, _pfx + msg)
 
 class AS3935(StdService):
     def __init__(self, engine, config_dict):
@@ -151,22 +206,36 @@ class AS3935(StdService):
         loginf("data_binding=%s" % self.data_binding)
         pkt_binding = svc_dict.get('binding', 'archive')
         loginf("binding=%s" % pkt_binding)
-
-        self.data = []
-
-        # if a binding was specified, then use it to save strikes to database
-        if self.data_binding is not None:
-            # configure the lightning database
-            dbm_dict = weewx.manager.get_manager_dict(
-                config_dict['DataBindings'], config_dict['Databases'],
-                self.data_binding, default_binding_dict=get_default_binding_dict())
-            with weewx.manager.open_manager(dbm_dict, initialize=True) as dbm:
-                # ensure schema on disk matches schema in memory
-                dbcol = dbm.connection.columnsOf(dbm.table_name)
-                memcol = [x[0] for x in dbm_dict['schema']]
-                if dbcol != memcol:
-                    raise Exception('as3935: schema mismatch: %s != %s' %
-                                    (dbcol, memcol))
+        # at least one distance must be kept to report an average
+        self.max_buffer = max(1, int(svc_dict.get('max_buffer', 4096)))
+        loginf("max_buffer=%s" % self.max_buffer)
+
+        # number of strikes since the last record, and the distances of the
+        # most recent of them
+        self._count = 0
+        self._dist = collections.deque(maxlen=self.max_buffer)
+        self._lock = threading.Lock()
+        self._running = True
+        # strikes waiting to be written to the lightning database
+        self._writeq = queue.Queue()
+        self._writer = None
+        self._dbm_dict = None
+        self._dbm = None
+        self._columns = None
+        # raw connection used to write strikes to a sqlite lightning database
+        self._conn = None
+        self._stmt_sql = None
+        # set by the writer when daily summaries need to catch up
+        self._need_backfill = False
+        # strikes that could not be written are kept here until a flush
+        # succeeds, even across restarts
+        self._deadletter = None
+        self._has_deadletter = False
+        self._deadletter_retry = 0
+        self._deadletter_wait = DEADLETTER_WAIT
+        self._deadletter_lock = threading.RLock()
+        # set at shutdown, after which failed writes are not retried
+        self._stopping = False
 
         # configure the sensor
         self.sensor = RPi_AS3935.RPi_AS3935(address=addr, bus=bus)
@@ -174,19 +243,40 @@ class AS3935(StdService):
         self.sensor.set_noise_floor(noise_floor)
         self.sensor.calibrate(tun_cap=calib)
 
-        # configure the gpio
-        GPIO.setmode(GPIO.BCM)
-        GPIO.setup(self.pin, GPIO.IN)
+        # configure the gpio.  pigpiod samples the pin and timestamps each
+        # edge, so the callback gets the time of the edge itself.
+        self._pi = pigpio.pi()
+        if not self._pi.connected:
+            raise Exception('as3935: cannot connect to pigpiod')
+        self._pi.set_mode(self.pin, pigpio.INPUT)
+
+        # if a binding was specified, then use it to save strikes to database.
+        # this is done after the sensor and gpio are set up, so a missing
+        # pigpiod fails before anything is opened.
+        if self.data_binding is not None:
+            try:
+                self._open_database(config_dict)
+            except Exception:
+                # let go of the gpio and whatever part of the database opened
+                self._close_database()
+                self._pi.stop()
+                raise
+            # all database writes happen on a dedicated writer thread
+            self._writer = threading.Thread(target=self.process_writes)
+            self._writer.daemon = True
+            self._writer.start()
+
+        # interrupts are queued by the gpio callback and handled by a worker
+        # thread, so the callback never waits on the sensor
+        self._interrupts = collections.deque(maxlen=256)
+        self._interrupt_event = threading.Event()
+        self._worker = threading.Thread(target=self.process_interrupts)
+        self._worker.daemon = True
+        self._worker.start()
 
         # add a gpio callback for the lightning strikes
-        try:
-            # be sure nothing is registered already...
-            GPIO.remove_event_detect(self.pin)
-        except:
-            pass
-        # ... then add our handler
-        GPIO.add_event_detect(self.pin, GPIO.RISING,
-                              callback=self.handle_interrupt)
+        self._cb = self._pi.callback(self.pin, pigpio.RISING_EDGE,
+                                     self.handle_interrupt)
 
         # on each new record, read then clear data since last record
         if pkt_binding.lower() == 'loop':
@@ -195,8 +285,81 @@ class AS3935(StdService):
             self.bind(weewx.NEW_ARCHIVE_RECORD, self.new_archive_record)
 
     def shutDown(self):
-        GPIO.remove_event_detect(self.pin)
-        GPIO.cleanup()
+        self._cb.cancel()
+        self._running = False
+        self._interrupt_event.set()
+        self._worker.join(5)
+        self._pi.stop()
+        if self._writer is not None:
+            # the writer saves anything still queued before it stops.  while
+            # stopping, a failed write is not retried and everything still
+            # queued goes straight to the dead letter file.
+            self._stopping = True
+            self._writeq.put(None)
+            self._writer.join(10)
+            if self._writer.is_alive():
+                # the writer is stuck on the database, so save what is left
+                # in the queue and leave the database open for it
+                logerr("writer did not stop, saving queued strikes")
+                self._drain_to_deadletter()
+                return
+            self._writer = None
+        self._close_database()
+
+    def _open_database(self, config_dict):
+        # a sqlite database stays open for as long as the service is running.
+        # other databases are opened for each batch, since a server may drop
+        # a connection that sits idle between storms.
+        self._dbm_dict = weewx.manager.get_manager_dict(
+            config_dict['DataBindings'], config_dict['Databases'],
+            self.data_binding, default_binding_dict=get_default_binding_dict())
+        self._dbm = weewx.manager.open_manager(self._dbm_dict,
+                                               initialize=True)
+        # ensure schema on disk matches schema in memory
+        dbcol = tuple(self._dbm.connection.columnsOf(self._dbm.table_name))
+        memcol = tuple(c for c, _ in self._dbm_dict['schema'])
+        if dbcol != memcol:
+            raise Exception('as3935: schema mismatch: %s != %s' %
+                            (dbcol, memcol))
+        self._columns = memcol
+        # the schema is fixed, so strikes in a sqlite database bypass the
+        # manager and are inserted directly
+        db_dict = self._dbm_dict['database_dict']
+        if db_dict.get('driver') == 'weedb.sqlite':
+            # use the file weedb actually opened, rather than resolving
+            # SQLITE_ROOT again here
+            cursor = self._dbm.connection.cursor()
+            try:
+                cursor.execute("PRAGMA database_list")
+                path = [row[2] for row in cursor.fetchall()
+                        if row[1] == 'main'][0]
+            finally:
+                cursor.close()
+            self._deadletter = path + '.deadletter.jsonl'
+            self._conn = sqlite3.connect(path, isolation_level=None,
+                                         check_same_thread=False)
+            for pragma in SQLITE_PRAGMAS:
+                self._conn.execute(pragma)
+            # the insert is generated once from the schema, so each
+            # batch only binds values
+            self._stmt_sql = "INSERT OR IGNORE INTO %s (%s) VALUES (%s)" % (
+                self._dbm.table_name, ', '.join(memcol),
+                ', '.join(['?'] * len(memcol)))
+        else:
+            self._deadletter = os.path.join(
+                config_dict.get('WEEWX_ROOT', ''),
+                '%s.deadletter.jsonl' % db_dict['database_name'])
+            self._dbm.close()
+            self._dbm = None
+        self._has_deadletter = os.path.exists(self._deadletter)
+
+    def _close_database(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+        if self._dbm is not None:
+            self._dbm.close()
+            self._dbm = None
 
     def new_loop_packet(self, event):
         self.read_data(event.packet)
@@ -205,37 +368,267 @@ class AS3935(StdService):
         self.read_data(event.record)
 
     def read_data(self, pkt):
-        avg = None
-        count = len(self.data)
-        if count:
-            avg = 0
-            for x in self.data:
-                avg += x[1]
-            avg /= count
+        # direct inserts bypass the manager, so once strikes have been
+        # written catch up any daily summaries here, on the thread that owns
+        # the manager
+        if self._need_backfill:
+            self._need_backfill = False
+            try:
+                self._dbm.backfill_day_summary()
+            except Exception as e:
+                logerr("backfill of daily summaries failed: %s" % e)
+        with self._lock:
+            count = self._count
+            dist = self._dist
+            self._count = 0
+            self._dist = collections.deque(maxlen=self.max_buffer)
+        avg = math.fsum(dist) / len(dist) if dist else None
         # if the record is not metric, convert from kilometers to miles
-        if 'usUnits' in pkt and pkt['usUnits'] == weewx.US:
-            avg = weewx.units.convert((avg, 'km', 'group_distance'), 'mile')[0]
+        if avg is not None and pkt.get('usUnits') == _US:
+            avg *= KM_TO_MILE
         # save the count and average
         pkt['lightning_distance'] = avg
         pkt['lightning_strike_count'] = count
-        # clear the count and average
-        self.data = []
 
     def save_data(self, strike_ts, distance):
-        if self.data_binding is None:
+        # queue the strike for the writer thread
+        if self._writer is None:
             return
-        rec = {'dateTime': strike_ts,
-               'usUnits': weewx.METRIC,
-               'distance': distance}
-        dbm_dict = weewx.manager.get_manager_dict(
-            self.config_dict['DataBindings'], self.config_dict['Databases'],
-            self.data_binding, default_binding_dict=get_default_binding_dict())
-        with weewx.manager.open_manager(dbm_dict) as dbm:
-            dbm.addRecord(rec)
-
-    def handle_interrupt(self, channel):
-        try:   
-            time.sleep(0.003)
+        self._writeq.put((strike_ts, _METRIC, distance))
+
+    def process_writes(self):
+        # write queued strikes until the None sentinel is received.  strikes
+        # that arrive while a batch is being written go in the next batch.
+        # strikes are queued as the positional tuples the insert binds, and
+        # the batch list is reused, so nothing is built per strike here.
+        batch = []
+        while True:
+            del batch[:]
+            try:
+                batch.append(self._writeq.get(timeout=FLUSH_INTERVAL))
+                while len(batch) < MAX_BATCH and batch[-1] is not None:
+                    batch.append(self._writeq.get_nowait())
+            except queue.Empty:
+                pass
+            done = bool(batch) and batch[-1] is None
+            if done:
+                batch.pop()
+            if not self._flush_batch(batch) and self._stopping:
+                self._drain_to_deadletter()
+                return
+            if done:
+                return
+
+    def _drain_to_deadletter(self):
+        batch = []
+        try:
+            while True:
+                x = self._writeq.get_nowait()
+                if x is not None:
+                    batch.append(x)
+        except queue.Empty:
+            pass
+        if batch:
+            self._save_deadletter(batch)
+
+    def _flush_batch(self, batch):
+        # dead letters that are due for a retry are written in their own
+        # transaction, so a bad one cannot take the new strikes down with
+        # it.  the dead letter file is removed only once they are committed.
+        # returns False if the database failed and strikes were saved as
+        # dead letters.
+        db_failed = False
+        if self._has_deadletter and not self._stopping and \
+                time.time() >= self._deadletter_retry:
+            dead = self._load_deadletter()
+            if not dead:
+                # nothing left to retry, for example an empty file left by a
+                # crash just after it was created
+                if self._has_deadletter:
+                    self._remove_deadletter()
+            else:
+                result = self._write_with_retries(dead)
+                if result:
+                    self._remove_deadletter()
+                elif result is None:
+                    # the database refused them, so keep them for inspection
+                    self._set_aside_deadletter()
+                else:
+                    db_failed = True
+                    self._backoff_deadletter()
+        if not batch:
+            return not db_failed
+        if db_failed:
+            # the database just failed, so save the new strikes right away
+            self._save_deadletter(batch)
+            return False
+        result = self._write_with_retries(batch)
+        if result:
+            # the database is working again, so retry dead letters now
+            self._deadletter_retry = 0
+            self._deadletter_wait = DEADLETTER_WAIT
+        elif result is not None:
+            self._save_deadletter(batch)
+            self._backoff_deadletter()
+            return False
+        return True
+
+    def _backoff_deadletter(self):
+        self._deadletter_retry = time.time() + self._deadletter_wait
+        self._deadletter_wait = min(2 * self._deadletter_wait,
+                                    DEADLETTER_MAX_WAIT)
+
+    def _write_with_retries(self, batch):
+        # returns True if the strikes were written, False if the database
+        # kept failing, or None if it refused them outright
+        tries = 1 if self._stopping else WRITE_TRIES
+        for attempt in range(tries):
+            try:
+                self._write_batch(batch)
+            except RETRY_ERRORS as e:
+                if attempt + 1 < tries and not self._stopping:
+                    logdbg("save of %d strikes failed (attempt %d of %d): %s"
+                           % (len(batch), attempt + 1, tries, e))
+                    time.sleep(RETRY_WAIT * (1 << attempt))
+                else:
+                    logerr("save of %d strikes failed after %d attempts: %s" %
+                           (len(batch), attempt + 1, e))
+                    return False
+            except Exception as e:
+                logerr("save of %d strikes rejected: %s" % (len(batch), e))
+                return None
+            else:
+                if self._conn is not None and \
+                        hasattr(self._dbm, 'backfill_day_summary'):
+                    self._need_backfill = True
+                return True
+        return False
+
+    def _load_deadletter(self):
+        # unreadable lines, such as one cut short by a power failure, are
+        # skipped.  the file is then moved aside and the good strikes are
+        # written to a clean file, so new dead letters are not appended to
+        # a broken one.
+        with self._deadletter_lock:
+            batch = []
+            bad = 0
+            try:
+                with open(self._deadletter) as f:
+                    for line in f:
+                        try:
+                            row = tuple(json.loads(line))
+                        except (ValueError, TypeError):
+                            row = None
+                        if row is None or len(row) != len(self._columns):
+                            bad += 1
+                        else:
+                            batch.append(row)
+            except (IOError, OSError) as e:
+                logerr("cannot read %s: %s" % (self._deadletter, e))
+                if not self._set_aside_deadletter():
+                    # stop trying rather than failing on every flush
+                    self._has_deadletter = False
+                return []
+            if bad:
+                logerr("skipped %d unreadable lines in %s" %
+                       (bad, self._deadletter))
+                if self._set_aside_deadletter() and batch:
+                    self._save_deadletter(batch)
+            logdbg("retrying %d strikes from %s" %
+                   (len(batch), self._deadletter))
+            return batch
+
+    def _set_aside_deadletter(self):
+        with self._deadletter_lock:
+            bad_path = '%s.%d.bad' % (self._deadletter, int(time.time()))
+            try:
+                os.rename(self._deadletter, bad_path)
+                self._has_deadletter = False
+                logerr("moved %s to %s" % (self._deadletter, bad_path))
+                return True
+            except OSError as e:
+                logerr("cannot move %s: %s" % (self._deadletter, e))
+                return False
+
+    def _remove_deadletter(self):
+        with self._deadletter_lock:
+            try:
+                os.remove(self._deadletter)
+                self._has_deadletter = False
+                loginf("saved strikes from %s" % self._deadletter)
+            except OSError as e:
+                # the strikes are saved, and retrying them is harmless
+                logerr("cannot remove %s: %s" % (self._deadletter, e))
+
+    def _save_deadletter(self, batch):
+        with self._deadletter_lock:
+            try:
+                with open(self._deadletter, 'a+b') as f:
+                    # start on a new line if the last append was cut short
+                    f.seek(0, os.SEEK_END)
+                    if f.tell():
+                        f.seek(-1, os.SEEK_END)
+                        if f.read(1) != b'\n':
+                            f.write(b'\n')
+                    for x in batch:
+                        f.write((json.dumps(x) + '\n').encode('ascii'))
+                    # the strikes exist nowhere else, so get them onto disk
+                    f.flush()
+                    os.fsync(f.fileno())
+                self._has_deadletter = True
+                logdbg("saved %d strikes to %s" %
+                       (len(batch), self._deadletter))
+            except (IOError, OSError) as e:
+                logerr("lost %d strikes: cannot write %s: %s" %
+                       (len(batch), self._deadletter, e))
+
+    def _write_batch(self, batch):
+        if self._conn is not None:
+            # strikes within the same second collide on dateTime, so keep
+            # the first one like addRecord would
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                self._conn.executemany(self._stmt_sql, batch)
+                self._conn.execute('COMMIT')
+            except Exception:
+                # a failed COMMIT can leave the transaction open, which would
+                # make every later BEGIN fail.  older pythons cannot tell, so
+                # they always roll back.
+                if getattr(self._conn, 'in_transaction', True):
+                    self._conn.execute('ROLLBACK')
+                raise
+        else:
+            # other databases go through the manager, which still adds the
+            # whole list in a single transaction.  addRecord logs and skips
+            # any record it cannot insert, so only a failure to connect gets
+            # retried or saved as a dead letter.
+            with weewx.manager.open_manager(self._dbm_dict) as dbm:
+                dbm.addRecord([dict(zip(self._columns, x)) for x in batch])
+
+    def handle_interrupt(self, gpio, level, tick):
+        self._interrupts.append(tick)
+        self._interrupt_event.set()
+
+    def process_interrupts(self):
+        while self._running:
+            self._interrupt_event.wait()
+            self._interrupt_event.clear()
+            while self._interrupts:
+                self.process_interrupt(self._interrupts.popleft())
+
+    def process_interrupt(self, tick):
+        try:
+            # the interrupt register is not valid until a few ms after the
+            # edge, so wait out whatever is left of that.  ticks are in
+            # microseconds and wrap, so always compare them with tickDiff.
+            # the edge time is the clock read alongside the current tick,
+            # less the age of the edge.
+            now_tick = self._pi.get_current_tick()
+            now_ns = _time_ns()
+            age = pigpio.tickDiff(tick, now_tick)
+            if age < 3000:
+                time.sleep((3000 - age) / 1000000.0)
+            edge_ns = now_ns - age * 1000
             reason = self.sensor.get_interrupt()
             if reason == 0x01:
                 loginf("noise level too high - adjusting (old value %s)" % self.sensor.get_noise_floor())
@@ -244,10 +637,12 @@ class AS3935(StdService):
                 loginf("detected disturber - masking")
                 self.sensor.set_mask_disturber(True)
             elif reason == 0x08:
-                strike_ts = int(time.time())
+                strike_ts = edge_ns // 1000000000
                 distance = float(self.sensor.get_distance())
                 loginf("strike at %s km" % distance)
-                self.data.append((strike_ts, distance))
+                with self._lock:
+                    self._count += 1
+                    self._dist.append(distance)
                 self.save_data(strike_ts, distance)
         except Exception as e:
             logerr("callback failed: %s" % e)